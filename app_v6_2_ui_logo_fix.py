@@ -1,25 +1,36 @@
 import os
+import time
 import base64
-import re
-from typing import Dict, List, Tuple
+import copy
+from collections import Counter
+from functools import lru_cache, wraps
+from typing import Dict, List, Optional, Tuple
 
 import pandas as pd
 import streamlit as st
 from openpyxl import load_workbook
 
+try:
+    # Optional fast xlsx reader; openpyxl remains the fallback
+    from python_calamine import CalamineWorkbook
+except ImportError:
+    CalamineWorkbook = None
+
 from st_aggrid import AgGrid, GridOptionsBuilder, GridUpdateMode, DataReturnMode
 
 
 # ----------------------------
 # Helpers
 # ----------------------------
+@lru_cache(maxsize=4096)
+def _norm_str(s: str) -> str:
+    # str.split() drops leading/trailing whitespace and collapses runs (incl. line breaks) without regex
+    return " ".join(s.lower().split())
+
+
 def norm(x) -> str:
-    """Normalization for matching only (NOT for UI)."""
-    s = "" if x is None else str(x)
-    s = s.replace("\n", " ")
-    s = s.strip().lower()
-    s = re.sub(r"\s+", " ", s)
-    return s
+    """Normalization for matching only (NOT for UI). Memoized: labels/headers repeat on every rerun."""
+    return _norm_str("" if x is None else str(x))
 
 
 def safe_display_value(v):
@@ -27,128 +38,256 @@ def safe_display_value(v):
     return "" if v is None else v
 
 
+def cell_text(v) -> str:
+    """Stripped text of a non-empty cell; values_only reads already give str for text cells."""
+    return v.strip() if isinstance(v, str) else str(v).strip()
+
+
 def file_mtime(path: str) -> float:
+    """Single os.stat() call; 0.0 means the file is missing/unreadable (doubles as an exists check)."""
     try:
-        return os.path.getmtime(path)
+        return os.stat(path).st_mtime
     except Exception:
         return 0.0
 
 
+def debug_enabled() -> bool:
+    """Debug mode is opt-in via the ?debug=1 query parameter."""
+    return st.query_params.get("debug") == "1"
+
+
+def track_cache_stats(fn):
+    """
+    Debug instrumentation for the cached readers (wrap OUTSIDE st.cache_*):
+    calls, estimated hits (argument keys already seen in this session) and wall time,
+    kept in st.session_state["_cache_stats"] and shown with ?debug=1.
+    Without ?debug=1 the wrapper calls straight through and collects nothing.
+    """
+
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        if not debug_enabled():
+            return fn(*args, **kwargs)
+
+        t0 = time.perf_counter()
+        result = fn(*args, **kwargs)
+        elapsed = time.perf_counter() - t0
+
+        stats = st.session_state.setdefault("_cache_stats", {})
+        entry = stats.setdefault(fn.__name__, {"calls": 0, "hits": 0, "seconds": 0.0, "keys": set()})
+        key = (args, tuple(sorted(kwargs.items())))
+        entry["calls"] += 1
+        entry["hits"] += key in entry["keys"]
+        entry["seconds"] += elapsed
+        entry["keys"].add(key)
+        return result
+
+    # Keep the cache API on the public name (e.g. read_formats_list_cached.clear())
+    wrapper.clear = fn.clear
+    return wrapper
+
+
+def render_cache_stats():
+    stats = st.session_state.get("_cache_stats", {})
+    rows = [
+        {
+            "function": name,
+            "calls": e["calls"],
+            "hits (est.)": e["hits"],
+            "misses (est.)": e["calls"] - e["hits"],
+            "total, ms": round(e["seconds"] * 1000, 2),
+            "avg, ms": round(e["seconds"] * 1000 / e["calls"], 3) if e["calls"] else 0.0,
+        }
+        for name, e in stats.items()
+    ]
+    with st.expander("Cache stats (debug)", expanded=True):
+        st.dataframe(pd.DataFrame(rows), hide_index=True)
+
+
+# Sheets the app reads from 'Калькулятор.xlsx'; extracted together in one workbook open.
+BOOK_SHEETS = ("Списки", "Описание", "Форматы", "Медиа факторы", "Фильтры")
+
+
+@track_cache_stats
+@st.cache_resource(show_spinner=False, max_entries=4)
+def read_workbook_rows(wb_path: str, mtime: float) -> Dict[str, List[tuple]]:
+    """
+    Open the workbook ONCE and materialize BOOK_SHEETS as lists of row tuples.
+    All sheet readers below share this snapshot (do not mutate it).
+    Uses calamine (Rust reader) when installed, otherwise openpyxl in read-only mode.
+    """
+    if CalamineWorkbook is not None:
+        return _read_rows_calamine(wb_path)
+    return _read_rows_openpyxl(wb_path)
+
+
+def _calamine_value(v):
+    """Match openpyxl values_only output: empty cell -> None, whole-number float -> int."""
+    if isinstance(v, str):
+        return v if v != "" else None
+    if isinstance(v, float) and v.is_integer():
+        return int(v)
+    return v
+
+
+def _read_rows_calamine(wb_path: str) -> Dict[str, List[tuple]]:
+    wb = CalamineWorkbook.from_path(wb_path)
+    try:
+        out: Dict[str, List[tuple]] = {}
+        for name in BOOK_SHEETS:
+            if name not in wb.sheet_names:
+                continue
+            # skip_empty_area=False keeps A1 as the origin (column indexes match the Excel letters)
+            rows = wb.get_sheet_by_name(name).to_python(skip_empty_area=False)
+            out[name] = [tuple(_calamine_value(v) for v in row) for row in rows]
+        return out
+    finally:
+        wb.close()
+
+
+def _read_rows_openpyxl(wb_path: str) -> Dict[str, List[tuple]]:
+    """
+    Read-only mode trusts the stored sheet dimension; some writers save a bogus 'A1:A1',
+    so in that case we reset it and let iter_rows() scan the real rows.
+    """
+    wb = load_workbook(wb_path, data_only=True, read_only=True, keep_links=False)
+    try:
+        out: Dict[str, List[tuple]] = {}
+        for name in BOOK_SHEETS:
+            if name not in wb.sheetnames:
+                continue
+            ws = wb[name]
+            if (ws.max_row or 1) <= 1 and (ws.max_column or 1) <= 1:
+                ws.reset_dimensions()
+            out[name] = list(ws.iter_rows(values_only=True))
+        return out
+    finally:
+        wb.close()
+
+
+def row_values(row: tuple, n: int) -> tuple:
+    """First n cell values of a row tuple, padded with None (rows may be shorter than n)."""
+    if len(row) >= n:
+        return row[:n]
+    return row + (None,) * (n - len(row))
+
+
+def sheet_rows(wb_path: str, sheet_name: str, mtime: Optional[float] = None) -> List[tuple]:
+    """Rows of one sheet from the shared workbook snapshot (mtime defaults to the file's current one)."""
+    if mtime is None:
+        mtime = file_mtime(wb_path)
+    return read_workbook_rows(wb_path, mtime)[sheet_name]
+
+
 # NOTE: to ensure dropdown lists refresh when Excel changes while Streamlit is running,
 # we key cache by the file mtime.
+@track_cache_stats
 @st.cache_data(show_spinner=False)
 def read_single_column_list_cached(wb_path: str, sheet_name: str, col: int, mtime: float) -> List[str]:
-    wb = load_workbook(wb_path, data_only=True)
-    ws = wb[sheet_name]
     out = []
-    for r in range(2, ws.max_row + 1):
-        v = ws.cell(r, col).value
-        if v is not None and str(v).strip() != "":
-            out.append(str(v).strip())
+    for row in sheet_rows(wb_path, sheet_name, mtime)[1:]:
+        v = row_values(row, col)[col - 1]
+        if v is not None and (v_str := cell_text(v)):
+            out.append(v_str)
     return out
 
 
+@track_cache_stats
 @st.cache_data(show_spinner=False)
 def read_formats_list_cached(wb_path: str, sheet_name: str, mtime: float) -> List[str]:
     """
     Sheet 'Форматы' can be two columns [Описание, Форматы].
     We take unique values from column 2 in stable order.
     """
-    wb = load_workbook(wb_path, data_only=True)
-    ws = wb[sheet_name]
     vals = []
-    for r in range(2, ws.max_row + 1):
-        v = ws.cell(r, 2).value
-        if v is not None and str(v).strip() != "":
-            vals.append(str(v).strip())
-    seen = set()
-    out = []
-    for x in vals:
-        if x not in seen:
-            seen.add(x)
-            out.append(x)
-    return out
+    for row in sheet_rows(wb_path, sheet_name, mtime)[1:]:
+        v = row_values(row, 2)[1]
+        if v is not None and (v_str := cell_text(v)):
+            vals.append(v_str)
+    # Stable-order dedup (dicts keep insertion order)
+    return list(dict.fromkeys(vals))
 
 
+@track_cache_stats
 @st.cache_data(show_spinner=False)
-def read_lists_options_cached(wb_path: str, sheet_name: str, mtime: float) -> Dict[str, List[str]]:
-    wb = load_workbook(wb_path, data_only=True)
-    ws = wb[sheet_name]
+def read_lists_options_cached(wb_path: str, sheet_name: str, mtime: float) -> Dict[str, Tuple[str, ...]]:
+    """Options per list name; tuples so selectbox options stay identical between reruns."""
     options: Dict[str, List[str]] = {}
-    for r in range(2, ws.max_row + 1):
-        f = ws.cell(r, 1).value
-        v = ws.cell(r, 2).value
+    for row in sheet_rows(wb_path, sheet_name, mtime)[1:]:
+        f, v = row_values(row, 2)
         if f is None or v is None:
             continue
-        f_str = str(f).strip()
-        v_str = str(v).strip()
-        if f_str and v_str:
+        if (f_str := cell_text(f)) and (v_str := cell_text(v)):
             options.setdefault(f_str, []).append(v_str)
-    return options
+    return {k: tuple(v) for k, v in options.items()}
 
 
-def find_media_headers_and_groups(wb_path: str, sheet_name: str = "Медиа факторы") -> Tuple[List[str], Dict[str, int]]:
+@track_cache_stats
+@st.cache_data(show_spinner=False)
+def read_dropdown_options_cached(wb_path: str, mtime: float) -> Dict[str, Tuple[str, ...]]:
+    """Table dropdown options (Описание/Форматы) built once per file version instead of on every rerun."""
+    return {
+        "Описание": tuple(read_single_column_list_cached(wb_path, "Описание", 1, mtime)),
+        "Форматы": tuple(read_formats_list_cached(wb_path, "Форматы", mtime)),
+    }
+
+
+@track_cache_stats
+@st.cache_data(show_spinner=False)
+def find_media_headers_and_groups(wb_path: str, sheet_name: str, mtime: float) -> Tuple[List[str], Dict[str, int]]:
     """
     Draft-mode allowed read:
     - headers row1 A..M (we will show B..M)
     - column A values to count rows per activation type
-    """
-    wb = load_workbook(wb_path, data_only=True)
-    ws = wb[sheet_name]
 
-    headers = [ws.cell(1, c).value for c in range(1, 14)]
-    headers = ["" if h is None else str(h) for h in headers]
+    The template does not change during a session, so the scan is cached by file mtime
+    (same as the list readers above) instead of being repeated on every rerun.
+    """
+    rows = sheet_rows(wb_path, sheet_name, mtime)
+    header_row = row_values(rows[0] if rows else (), 13)
+    headers = ["" if h is None else str(h) for h in header_row]
 
-    group_counts: Dict[str, int] = {}
-    for r in range(2, ws.max_row + 1):
-        a = ws.cell(r, 1).value
-        if a is None:
-            continue
-        key = str(a).strip()
-        if key:
-            group_counts[key] = group_counts.get(key, 0) + 1
+    col_a = (row_values(row, 1)[0] for row in rows[1:])
+    group_counts: Dict[str, int] = dict(
+        Counter(key for a in col_a if a is not None and (key := cell_text(a)))
+    )
 
     return headers, group_counts
 
 
-def read_media_factors_truth(wb_path: str, sheet_name: str = "Медиа факторы") -> Tuple[List[str], pd.DataFrame]:
+def read_media_factors_truth(
+    wb_path: str, sheet_name: str = "Медиа факторы", mtime: Optional[float] = None
+) -> Tuple[List[str], pd.DataFrame]:
     """Read full A..M (truth) with data_only=True; return headers and dataframe."""
-    wb = load_workbook(wb_path, data_only=True)
-    ws = wb[sheet_name]
-
-    headers = [ws.cell(1, c).value for c in range(1, 14)]
-    headers = ["" if h is None else str(h) for h in headers]
-
-    rows = []
-    for r in range(2, ws.max_row + 1):
-        row = [safe_display_value(ws.cell(r, c).value) for c in range(1, 14)]
-        if all(v == "" for v in row):
-            continue
-        rows.append(row)
-
-    df = pd.DataFrame(rows, columns=headers)
+    rows_all = sheet_rows(wb_path, sheet_name, mtime)
+    header_row = row_values(rows_all[0] if rows_all else (), 13)
+    headers = ["" if h is None else str(h) for h in header_row]
+
+    rows = [tuple(safe_display_value(v) for v in row_values(values, 13)) for values in rows_all[1:]]
+    df = pd.DataFrame.from_records(rows, columns=headers)
+    # Drop fully empty rows in one vectorized pass; then let pandas pick typed (string/Int64) columns
+    df = df[~(df == "").all(axis=1)].reset_index(drop=True).convert_dtypes()
     return headers, df
 
 
-def read_filters_rows_truth(wb_path: str, sheet_name: str = "Фильтры") -> List[Dict[str, object]]:
+def read_filters_rows_truth(
+    wb_path: str, sheet_name: str = "Фильтры", mtime: Optional[float] = None
+) -> List[Dict[str, object]]:
     """
     Read sheet 'Фильтры' as row list (truth).
     Expected headers: A=Блок, B=Название, C=Данные
     """
-    wb = load_workbook(wb_path, data_only=True)
-    ws = wb[sheet_name]
     out = []
-    for r in range(2, ws.max_row + 1):
-        block = ws.cell(r, 1).value
-        name = ws.cell(r, 2).value
-        val = ws.cell(r, 3).value
+    for row in sheet_rows(wb_path, sheet_name, mtime)[1:]:
+        block, name, val = row_values(row, 3)
         if block is None and name is None and val is None:
             continue
+        name_str = "" if name is None else cell_text(name)
         out.append(
             {
-                "block": "" if block is None else str(block).strip(),
-                "name": "" if name is None else str(name).strip(),
-                "name_norm": norm(name),
+                "block": "" if block is None else cell_text(block),
+                "name": name_str,
+                "name_norm": norm(name_str),
                 "value": safe_display_value(val),
             }
         )
@@ -164,7 +303,7 @@ ACTIVATION_TYPES = [
     "Тип активации: ДОПОЛНИТЕЛЬНЫЕ АКТИВАЦИИ ПОСЛЕ МЕРОПРИЯТИЯ",
 ]
 
-AUTO_FILTER_LABELS = {
+AUTO_FILTER_LABELS = frozenset({
     norm("ЦА (унифицированная аудитория для всех медиа, тыс. 16+)"),
     norm("Кол-во посетителей всего, тыс."),
     norm("Общий бюджет"),
@@ -172,7 +311,7 @@ AUTO_FILTER_LABELS = {
     norm("Стоимость за контакт"),
     norm("Стоимость за охваченного пользователя"),
     norm("Стоимость за посетителя мероприятия"),
-}
+})
 
 # Editable in draft only
 EDITABLE_FILTER_LABELS = [
@@ -187,6 +326,44 @@ EDITABLE_FILTER_LABELS = [
     "Продакшен фото-зоны и лайтбокса, букингсекретных артистов",
 ]
 
+# Draft-view top block fields: (label, widget key, norm(label)), per column
+DRAFT_PARAM_FIELDS: Tuple[Tuple[str, str, str], ...] = tuple(
+    (lab, key, norm(lab))
+    for lab, key in (
+        ("количество дней на фестивале/площадке", "w_days"),
+        ("Общий период размещения", "w_period"),
+        ("План посетителей (в тыс. человек)", "w_plan_visitors"),
+    )
+)
+DRAFT_PLAN_FIELDS: Tuple[Tuple[str, str, str], ...] = tuple(
+    (lab, key, norm(lab))
+    for lab, key in (
+        ("Средняя цена билета", "w_ticket"),
+        ("GMV", "w_gmv"),
+        ("Агентская комиссия", "w_fee"),
+        ("Количество проданных билетов через виджит/витрину", "w_widget"),
+    )
+)
+DRAFT_BUDGET_FIELDS: Tuple[Tuple[str, str, str], ...] = tuple(
+    (lab, key, norm(lab))
+    for lab, key in (
+        ("Интеграционный платеж (организатору)", "w_integration"),
+        ("Продакшен фото-зоны и лайтбокса, букингсекретных артистов", "w_production"),
+    )
+)
+# AUTO (disabled) fields
+DRAFT_EFFICIENCY_FIELDS: Tuple[Tuple[str, str, str], ...] = tuple(
+    (lab, key, norm(lab))
+    for lab, key in (
+        ("Стоимость привлеченного клиента", "auto_cac"),
+        ("Стоимость за контакт", "auto_cpc"),
+        ("Стоимость за охваченного пользователя", "auto_cpu"),
+        ("Стоимость за посетителя мероприятия", "auto_cpv"),
+    )
+)
+# User-editable inputs committed to filter_inputs on 'Рассчитать'
+DRAFT_INPUT_FIELDS = DRAFT_PARAM_FIELDS + DRAFT_PLAN_FIELDS + DRAFT_BUDGET_FIELDS
+
 EDITABLE_TABLE_COLS_DRAFT = [
     "Описание",
     "Форматы",
@@ -198,9 +375,18 @@ EDITABLE_TABLE_COLS_DRAFT = [
     "Характеристики инвентаря и аудитории",
     "Хронометраж",
 ]
+EDITABLE_TABLE_COL_NORMS = frozenset(norm(x) for x in EDITABLE_TABLE_COLS_DRAFT)
+DROPDOWN_COL_NORMS = frozenset({norm("Описание"), norm("Форматы")})
+
+
+# AgGrid style for AUTO columns (one shared dict for every grid)
+AUTO_CELL_STYLE = {"backgroundColor": "#FF0032", "color": "#FFFFFF"}
+# Same colors as CSS properties for the pandas Styler of the draft editors
+AUTO_CELL_CSS = {"background-color": "#FF0032", "color": "#FFFFFF"}
 
 
 # Auto columns: robust detection (line breaks / spacing)
+@lru_cache(maxsize=256)
 def is_auto_table_col(col_name: str) -> bool:
     c = norm(col_name)
     if ("ots 16+" in c) and ("с учетом доли брендирования" in c):
@@ -215,9 +401,9 @@ def is_auto_table_col(col_name: str) -> bool:
 # ----------------------------
 # Styling
 # ----------------------------
-def inject_css():
-    st.markdown(
-        """
+# Static stylesheet, built once at import. It is still emitted on every rerun:
+# Streamlit drops elements that a rerun does not re-send, so an "inject once" guard would unstyle the page.
+APP_CSS = """
 <style>
 
 /* =========================
@@ -499,7 +685,7 @@ button:focus { outline: 2px solid #FF0032 !important; }
 }
 
 
-/* Legend above Calculate button */
+/* Legend under the activation tables (Рассчитать is the inputs form submit, above the tables) */
 .mtc-legend {
   display: flex;
   flex-wrap: wrap;
@@ -647,9 +833,20 @@ div[data-testid="stImage"] img{ border-radius:0 !important; }
   overflow: visible !important;
 }
 </style>
-        """,
-        unsafe_allow_html=True,
-    )
+"""
+
+
+# Legend under the activation tables (static; still re-emitted each rerun, see APP_CSS)
+LEGEND_HTML = """<div class="mtc-legend">
+  <span class="mtc-legend-item"><span class="mtc-swatch red"></span>🔴 Авторасчёт</span>
+  <span class="mtc-legend-item"><span class="mtc-swatch white"></span>⬜ Ввод пользователя</span>
+</div>"""
+
+
+def inject_css():
+    st.markdown(APP_CSS, unsafe_allow_html=True)
+
+
 def ro_field(label: str, value, auto: bool = False):
     v = "" if value is None else value
     v_str = str(v) if v != "" else ""
@@ -668,40 +865,61 @@ def ro_field(label: str, value, auto: bool = False):
 # ----------------------------
 # State
 # ----------------------------
+STATE_DEFAULTS = {
+    "calculated": False,
+    "geo": "Москва",
+    "venue_type": "Площадка",
+    "filter_inputs": {},
+    "table_inputs": {},
+    "truth_filters_rows": [],
+    "truth_tables": {},
+}
+
+
 def ensure_state():
-    st.session_state.setdefault("calculated", False)
-    st.session_state.setdefault("geo", "Москва")
-    st.session_state.setdefault("venue_type", "Площадка")
-    st.session_state.setdefault("filter_inputs", {})
-    st.session_state.setdefault("table_inputs", {})
-    st.session_state.setdefault("truth_filters_rows", [])
-    st.session_state.setdefault("truth_tables", {})
+    # Fill only missing keys in one update. Not a one-time flag: 'geo'/'venue_type' are widget keys
+    # that Streamlit drops while their selectboxes are not rendered (calculated mode).
+    # Values are copied so sessions never share the module-level dicts/lists.
+    missing = {k: copy.copy(v) for k, v in STATE_DEFAULTS.items() if k not in st.session_state}
+    if missing:
+        st.session_state.update(missing)
 
 
 # ----------------------------
 # Table helpers
 # ----------------------------
 def build_empty_table(headers_b_to_m: List[str], n_rows: int) -> pd.DataFrame:
-    return pd.DataFrame([["" for _ in headers_b_to_m] for _ in range(n_rows)], columns=headers_b_to_m)
+    # Scalar broadcast: one typed block, no per-cell Python lists
+    return pd.DataFrame("", index=range(n_rows), columns=headers_b_to_m, dtype="string")
+
+
+@lru_cache(maxsize=16)
+def empty_table_cached(headers_b_to_m: Tuple[str, ...], n_rows: int) -> pd.DataFrame:
+    """Shared fallback table (read-only: copy before handing it to anything that may mutate it)."""
+    return build_empty_table(list(headers_b_to_m), n_rows)
 
 
 def split_tables_from_truth(df_a_to_m: pd.DataFrame, headers: List[str]) -> Dict[str, pd.DataFrame]:
     col_a = headers[0]
     cols_b_to_m = headers[1:13]  # B..M
-    out: Dict[str, pd.DataFrame] = {}
-    for act in ACTIVATION_TYPES:
-        part = df_a_to_m[df_a_to_m[col_a].astype(str).apply(lambda x: str(x).strip()) == act]
-        out[act] = part[cols_b_to_m].copy().reset_index(drop=True)
-    return out
-
-
-def aggrid_table(
-    df: pd.DataFrame,
-    editable: bool,
-    dropdown_options: Dict[str, List[str]],
-    height: int,
-    key: str,
-) -> pd.DataFrame:
+    # One vectorized strip of column A + one groupby (instead of a masked scan per activation type)
+    key = df_a_to_m[col_a].astype("string").str.strip()
+    groups = dict(iter(df_a_to_m.groupby(key, sort=False)))
+    empty = df_a_to_m.iloc[0:0]
+    # Dropdown-driven columns repeat a handful of list values: store them as categoricals.
+    # Numeric columns keep their dtype (float32 would show rounding noise like 0.1 -> 0.100000001).
+    as_category = {c: "category" for c in cols_b_to_m if norm(c) in DROPDOWN_COL_NORMS}
+    return {
+        act: groups.get(act, empty)[cols_b_to_m].reset_index(drop=True).astype(as_category)
+        for act in ACTIVATION_TYPES
+    }
+
+
+def aggrid_table(df: pd.DataFrame, height: int, key: str):
+    """
+    Read-only AgGrid for a truth table (draft tables use draft_table_editor).
+    Numeric dtypes are kept so numbers render as in Excel; AUTO columns are painted red.
+    """
     gb = GridOptionsBuilder.from_dataframe(df)
 
     # Make columns readable by default:
@@ -719,111 +937,116 @@ def aggrid_table(
         minWidth=140,
     )
 
-    editable_norms = {norm(x) for x in EDITABLE_TABLE_COLS_DRAFT}
-    dropdown_norms = {norm("Описание"), norm("Форматы")}
-
-    for col in df.columns:
-        ncol = norm(col)
-        auto_col = is_auto_table_col(col)
-
-        can_edit = False
-        if editable and (ncol in editable_norms) and (not auto_col):
-            can_edit = True
-
-        if ncol in dropdown_norms:
-            if can_edit:
-                gb.configure_column(
-                    col,
-                    editable=True,
-                    cellEditor="agSelectCellEditor",
-                    cellEditorParams={"values": dropdown_options.get(col, [])},
-                )
-            else:
-                gb.configure_column(col, editable=False)
-        else:
-            gb.configure_column(col, editable=can_edit)
+    # Classify headers once per grid (both helpers are memoized across reruns)
+    col_flags = [(col, norm(col), is_auto_table_col(col)) for col in df.columns]
 
+    # All columns are read-only in one batch; only hidden and AUTO-styled columns need per-column calls.
+    for col, ncol, auto_col in col_flags:
         if 'auto_unique_id' in ncol:
             gb.configure_column(col, hide=True)
         elif auto_col:
-            gb.configure_column(
-                col,
-                cellStyle={"backgroundColor": "#FF0032", "color": "#FFFFFF"},
-                editable=False,
-            )
+            gb.configure_column(col, cellStyle=AUTO_CELL_STYLE, editable=False)
+
+    gb.configure_columns(list(df.columns), editable=False)
 
     gb.configure_grid_options(domLayout="normal")
     grid_options = gb.build()
 
-    resp = AgGrid(
+    AgGrid(
         df,
         gridOptions=grid_options,
-        data_return_mode=DataReturnMode.FILTERED_AND_SORTED,
-        update_mode=GridUpdateMode.MODEL_CHANGED,
+        # Sorting/filtering are disabled, so the grid data is always the input order: skip re-sorting on return.
+        data_return_mode=DataReturnMode.AS_INPUT,
+        # Read-only view: never send grid state back (no rerun / data round-trip from the browser)
+        update_mode=GridUpdateMode.NO_UPDATE,
         allow_unsafe_jscode=False,
         theme="alpine",
         height=height,
         fit_columns_on_grid_load=True,
         key=key,
     )
-    return resp["data"]
-
-
-# ----------------------------
-# Main
-# ----------------------------
-def main():
-    st.set_page_config(page_title="Калькулятор оценки мероприятий", layout="wide")
-    inject_css()
-    ensure_state()
-
-    root_xlsx = "Калькулятор.xlsx"
-    root_moscow_xlsx = "Калькулятор_Москва.xlsx"
-
-    if not os.path.exists(root_xlsx) or not os.path.exists(root_moscow_xlsx):
-        st.error(
-            "Не найдены файлы в корне репозитория. "
-            "Положите рядом с app_v3.py файлы: 'Калькулятор.xlsx' и 'Калькулятор_Москва.xlsx'."
-        )
-        return
-
-    xlsx_mtime = file_mtime(root_xlsx)
-
-    # Draft-time allowed sources (refresh on Excel change via cache key mtime)
-    lists_options = read_lists_options_cached(root_xlsx, "Списки", xlsx_mtime)
-    geo_options = lists_options.get("ГЕО", [])
-    venue_options = lists_options.get("Тип площадки", [])
 
-    descr_options = read_single_column_list_cached(root_xlsx, "Описание", 1, xlsx_mtime)
-    format_options = read_formats_list_cached(root_xlsx, "Форматы", xlsx_mtime)
 
-    # Ensure defaults (must be done BEFORE selectboxes; do not pass index => avoids yellow Streamlit warning)
-    if geo_options:
-        if st.session_state["geo"] not in geo_options:
-            st.session_state["geo"] = "Москва" if "Москва" in geo_options else geo_options[0]
-    if venue_options:
-        if st.session_state["venue_type"] not in venue_options:
-            st.session_state["venue_type"] = "Площадка" if "Площадка" in venue_options else venue_options[0]
+def draft_table_editor(
+    df: pd.DataFrame,
+    dropdown_options: Dict[str, Tuple[str, ...]],
+    height: int,
+    key: str,
+) -> pd.DataFrame:
+    """
+    Editable draft table on native st.data_editor (Arrow transport, no AgGrid JSON round-trip).
+    Only EDITABLE_TABLE_COLS_DRAFT are editable, AUTO columns are locked,
+    Описание/Форматы are dropdowns. AUTO columns are painted red through a pandas Styler.
+    """
+    column_config = {}
+    auto_cols = []
+    for col in df.columns:
+        ncol = norm(col)
+        auto_col = is_auto_table_col(col)
+        can_edit = (ncol in EDITABLE_TABLE_COL_NORMS) and (not auto_col)
+        if auto_col:
+            auto_cols.append(col)
 
-    # Draft-mode allowed: only headers A..M and column A for grouping
-    media_headers_a_to_m, group_counts = find_media_headers_and_groups(root_xlsx, "Медиа факторы")
-    headers_b_to_m = media_headers_a_to_m[1:13]
+        if 'auto_unique_id' in ncol:
+            column_config[col] = None  # hidden
+        elif can_edit and ncol in DROPDOWN_COL_NORMS:
+            column_config[col] = st.column_config.SelectboxColumn(col, options=dropdown_options.get(col, ()))
+        else:
+            column_config[col] = st.column_config.TextColumn(col, disabled=not can_edit)
+
+    data = df.style.set_properties(subset=auto_cols, **AUTO_CELL_CSS) if auto_cols else df
+    return st.data_editor(
+        data,
+        column_config=column_config,
+        num_rows="fixed",
+        hide_index=True,
+        height=height,
+        key=key,
+    )
 
-    # Init empty tables once
-    if not st.session_state["table_inputs"]:
-        for act in ACTIVATION_TYPES:
-            st.session_state["table_inputs"][act] = build_empty_table(headers_b_to_m, int(group_counts.get(act, 0)))
 
+@st.fragment
+def render_tables(headers_b_to_m: List[str], group_counts: Dict[str, int], dropdown_options: Dict[str, Tuple[str, ...]]):
+    """
+    Activation tables. A fragment: editing a draft table reruns only this block, not the parameter
+    columns/header. Mode and truth data are read from session_state so fragment reruns never see stale args.
+    """
     calculated = bool(st.session_state["calculated"])
-    truth_rows = st.session_state.get("truth_filters_rows", [])
     truth_tables = st.session_state.get("truth_tables", {})
-    # Header (title + logo)
-    # NOTE: We render the header (title + logo) as a single HTML block.
-    # This avoids layout/cropping issues that can happen when trying to "wrap"
-    # Streamlit widgets (st.title/st.image) with HTML opened/closed in separate
-    # st.markdown calls (Streamlit renders each widget as a separate DOM block).
 
-    # Keep logo path discovery logic unchanged
+    headers_key = tuple(headers_b_to_m)
+    for act in ACTIVATION_TYPES:
+        # Only the first activation is open on load; the other grids are laid out when expanded.
+        with st.expander(act, expanded=(act == ACTIVATION_TYPES[0])):
+            if calculated:
+                df_show = truth_tables.get(act)
+                if df_show is None:
+                    # AgGrid adds its row-id column in place: never hand it the shared cached frame
+                    df_show = empty_table_cached(headers_key, 0).copy()
+                aggrid_table(
+                    df=df_show,
+                    height=240 if len(df_show) <= 6 else 360,
+                    key=f"grid_truth_{norm(act)}",
+                )
+            else:
+                # The editor keeps the user's edits in its own widget state (key), so it is always fed
+                # the same pristine table; the edited result is mirrored into table_inputs.
+                df_base = empty_table_cached(headers_key, int(group_counts.get(act, 0)))
+                df_new = draft_table_editor(
+                    df=df_base,
+                    dropdown_options=dropdown_options,
+                    height=240 if len(df_base) <= 6 else 360,
+                    key=f"de_{norm(act)}",
+                )
+                st.session_state["table_inputs"][act] = df_new
+
+
+# ----------------------------
+# Header logo
+# ----------------------------
+@st.cache_resource(show_spinner=False)
+def find_logo_path() -> Optional[str]:
+    """Logo discovery (filesystem probing) runs once per process, not on every rerun."""
     logo_path = None
     try:
         script_dir = os.path.dirname(os.path.abspath(__file__))
@@ -858,6 +1081,116 @@ def main():
                 break
     except Exception:
         logo_path = None
+    return logo_path
+
+
+@st.cache_resource(show_spinner=False, max_entries=8)
+def read_file_bytes(path: str, mtime: float) -> bytes:
+    """Raw file bytes (logo, download file), read once per file version and shared (bytes are immutable)."""
+    with open(path, "rb") as f:
+        return f.read()
+
+
+# ----------------------------
+# Actions
+# ----------------------------
+@track_cache_stats
+@st.cache_data(show_spinner=False)
+def read_truth_cached(wb_path: str, mtime: float) -> Tuple[List[Dict[str, object]], Dict[str, pd.DataFrame]]:
+    """Truth pipeline ('Фильтры' rows + per-activation tables), cached by file mtime like the draft readers."""
+    truth_rows = read_filters_rows_truth(wb_path, "Фильтры", mtime)
+    headers_truth, df_truth_a_to_m = read_media_factors_truth(wb_path, "Медиа факторы", mtime)
+    return truth_rows, split_tables_from_truth(df_truth_a_to_m, headers_truth)
+
+
+def run_calculation(wb_path: str):
+    """
+    'Рассчитать' form-submit callback.
+    Runs after the form values (ГЕО / Тип площадки included) are committed and before the script rerun,
+    so the page renders in calculated mode without an extra st.rerun().
+    """
+    for _, key, nlab in DRAFT_INPUT_FIELDS:
+        st.session_state["filter_inputs"][nlab] = st.session_state.get(key, "")
+    truth_rows, truth_tables = read_truth_cached(wb_path, file_mtime(wb_path))
+    st.session_state["truth_filters_rows"] = truth_rows
+    st.session_state["truth_tables"] = truth_tables
+
+    st.session_state["calculated"] = True
+
+
+# ----------------------------
+# Download
+# ----------------------------
+@st.fragment
+def render_download(path: str, mtime: float):
+    """
+    Download Москва-file "as is" (no openpyxl, no modification).
+    Rendered as a fragment: clicking the button reruns only this block, not the whole page.
+    Bytes come from the cache (keyed by mtime), so reruns do no file IO; main() has already checked the file exists.
+    """
+    st.download_button(
+        label="💾 Скачать файл (.xlsx)",
+        data=read_file_bytes(path, mtime),
+        file_name="Калькулятор_Москва.xlsx",
+        mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+    )
+
+
+# ----------------------------
+# Main
+# ----------------------------
+def main():
+    st.set_page_config(page_title="Калькулятор оценки мероприятий", layout="wide")
+    inject_css()
+    ensure_state()
+
+    root_xlsx = "Калькулятор.xlsx"
+    root_moscow_xlsx = "Калькулятор_Москва.xlsx"
+
+    # One stat per rerun per file: the mtime is both the existence check and the cache key below
+    xlsx_mtime = file_mtime(root_xlsx)
+    moscow_mtime = file_mtime(root_moscow_xlsx)
+    if not xlsx_mtime or not moscow_mtime:
+        st.error(
+            "Не найдены файлы в корне репозитория. "
+            "Положите рядом с app_v3.py файлы: 'Калькулятор.xlsx' и 'Калькулятор_Москва.xlsx'."
+        )
+        return
+
+    calculated = bool(st.session_state["calculated"])
+
+    # Draft-time allowed sources (refresh on Excel change via cache key mtime).
+    # Only the draft view shows these selectboxes/dropdowns, so calculated reruns skip the readers.
+    geo_options: Tuple[str, ...] = ()
+    venue_options: Tuple[str, ...] = ()
+    dropdown_options: Dict[str, Tuple[str, ...]] = {}
+    if not calculated:
+        lists_options = read_lists_options_cached(root_xlsx, "Списки", xlsx_mtime)
+        geo_options = lists_options.get("ГЕО", ())
+        venue_options = lists_options.get("Тип площадки", ())
+
+        dropdown_options = read_dropdown_options_cached(root_xlsx, xlsx_mtime)
+
+        # Ensure defaults (must be done BEFORE selectboxes; do not pass index => avoids yellow Streamlit warning)
+        if geo_options:
+            if st.session_state["geo"] not in geo_options:
+                st.session_state["geo"] = "Москва" if "Москва" in geo_options else geo_options[0]
+        if venue_options:
+            if st.session_state["venue_type"] not in venue_options:
+                st.session_state["venue_type"] = "Площадка" if "Площадка" in venue_options else venue_options[0]
+
+    # Draft-mode allowed: only headers A..M and column A for grouping
+    media_headers_a_to_m, group_counts = find_media_headers_and_groups(root_xlsx, "Медиа факторы", xlsx_mtime)
+    headers_b_to_m = media_headers_a_to_m[1:13]
+
+    truth_rows = st.session_state.get("truth_filters_rows", [])
+    # Header (title + logo)
+    # NOTE: We render the header (title + logo) as a single HTML block.
+    # This avoids layout/cropping issues that can happen when trying to "wrap"
+    # Streamlit widgets (st.title/st.image) with HTML opened/closed in separate
+    # st.markdown calls (Streamlit renders each widget as a separate DOM block).
+
+    logo_path = find_logo_path()
 
     # --- Header (title left, logo right) ---
     # Keep it pure Streamlit (st.columns + st.image) to avoid base64-HTML rendering quirks.
@@ -871,18 +1204,16 @@ def main():
         # Marker node used for stable CSS targeting of the following Streamlit image block.
         # We don't wrap st.image with HTML because Streamlit renders each element as a separate block.
         st.markdown('<div class="mtc-header-right"></div>', unsafe_allow_html=True)
-        if logo_path and os.path.exists(logo_path):
-            st.image(logo_path, width=320)
-
-    # Top blocks (4 columns)
-    # ----------------------------
-    col1, col2, col3, col4 = st.columns(4)
+        logo_mtime = file_mtime(logo_path) if logo_path else 0.0
+        if logo_mtime:
+            st.image(read_file_bytes(logo_path, logo_mtime), width=320)
 
     # Draft helpers
-    def draft_value(label: str) -> str:
-        if norm(label) in AUTO_FILTER_LABELS:
+    def draft_value(label_norm: str) -> str:
+        """Saved draft input for an already-normalized label (see DRAFT_*_FIELDS)."""
+        if label_norm in AUTO_FILTER_LABELS:
             return ""
-        return st.session_state["filter_inputs"].get(norm(label), "")
+        return st.session_state["filter_inputs"].get(label_norm, "")
 
     def render_block_truth(block_name: str):
         """Render ALL rows from sheet 'Фильтры' for the given block, in Excel order."""
@@ -893,140 +1224,92 @@ def main():
             val = row.get("value", "")
             ro_field(label, val, auto=(row.get("name_norm", "") in AUTO_FILTER_LABELS))
 
-    with col1:
-        st.subheader("⚙️ Параметры")
+    # Top blocks (4 columns)
+    # ----------------------------
+    # Draft inputs live in a form: typing does not rerun the whole page (tables included).
+    # 'Рассчитать' is the form's only submit button, so pending values (ГЕО / Тип площадки included)
+    # are always committed before run_calculation runs. It therefore sits under the inputs, above the tables:
+    # a button below the tables would be outside the form and would drop uncommitted values.
+    top_blocks = st.container() if calculated else st.form("inputs_form", border=False)
+    with top_blocks:
+        col1, col2, col3, col4 = st.columns(4)
+
+        # One header per column: st.columns stacks on narrow screens and each header must stay above its block
+        with col1:
+            st.subheader("⚙️ Параметры")
+
+            if calculated:
+                # Render entire block from Excel (includes ЦА and other параметрические строки)
+                render_block_truth("ПАРАМЕТРЫ")
+                # GEO & venue type per spec: keep chosen values, read-only, NOT blue
+                ro_field("ГЕО", st.session_state["geo"], auto=False)
+                ro_field("Тип площадки", st.session_state["venue_type"], auto=False)
+            else:
+                # Draft view: ЦА is AUTO => blue disabled input (empty)
+                st.text_input(
+                    "ЦА (унифицированная аудитория для всех медиа, тыс. 16+)",
+                    value="",
+                    disabled=True,
+                    key="auto_ca",
+                )
+
+                st.selectbox("ГЕО", options=geo_options or ("Москва",), key="geo")
+                st.selectbox("Тип площадки", options=venue_options or ("Площадка",), key="venue_type")
+
+                # Draft editable inputs (must persist)
+                for lab, key, nlab in DRAFT_PARAM_FIELDS:
+                    st.text_input(lab, value=str(draft_value(nlab)), key=key)
+
+        with col2:
+            st.subheader("🎯 Плановый результат")
+            if calculated:
+                render_block_truth("ПЛАНОВЫЙ РЕЗУЛЬТАТ МЕРОПРИЯТИЯ")
+            else:
+                # Draft: show required fields; AUTO is blue disabled and empty
+                st.text_input("Кол-во посетителей всего, тыс.", value="", disabled=True, key="auto_visitors_total")
+                for lab, key, nlab in DRAFT_PLAN_FIELDS:
+                    st.text_input(lab, value=str(draft_value(nlab)), key=key)
+
+        with col3:
+            st.subheader("💰 Бюджет")
+            if calculated:
+                render_block_truth("БЮДЖЕТ")
+            else:
+                for lab, key, nlab in DRAFT_BUDGET_FIELDS:
+                    st.text_input(lab, value=str(draft_value(nlab)), key=key)
+                st.text_input("Общий бюджет", value="", disabled=True, key="auto_total_budget")
+
+        with col4:
+            st.subheader("📈 Эффективность")
+            if calculated:
+                render_block_truth("ЭФФЕКТИВНОСТЬ")
+            else:
+                for lab, key, _ in DRAFT_EFFICIENCY_FIELDS:
+                    st.text_input(lab, value="", disabled=True, key=key)
 
         if calculated:
-            # Render entire block from Excel (includes ЦА and other параметрические строки)
-            render_block_truth("ПАРАМЕТРЫ")
-            # GEO & venue type per spec: keep chosen values, read-only, NOT blue
-            ro_field("ГЕО", st.session_state["geo"], auto=False)
-            ro_field("Тип площадки", st.session_state["venue_type"], auto=False)
-        else:
-            # Draft view: ЦА is AUTO => blue disabled input (empty)
-            st.text_input(
-                "ЦА (унифицированная аудитория для всех медиа, тыс. 16+)",
-                value="",
-                disabled=True,
-                key="auto_ca",
-            )
-
-            st.selectbox("ГЕО", options=geo_options if geo_options else ["Москва"], key="geo")
-            st.selectbox("Тип площадки", options=venue_options if venue_options else ["Площадка"], key="venue_type")
-
-            # Draft editable inputs (must persist)
-            for lab, key in [
-                ("количество дней на фестивале/площадке", "w_days"),
-                ("Общий период размещения", "w_period"),
-                ("План посетителей (в тыс. человек)", "w_plan_visitors"),
-            ]:
-                st.text_input(lab, value=str(draft_value(lab)), key=key)
-                st.session_state["filter_inputs"][norm(lab)] = st.session_state.get(key, "")
-
-    with col2:
-        st.subheader("🎯 Плановый результат")
-        if calculated:
-            render_block_truth("ПЛАНОВЫЙ РЕЗУЛЬТАТ МЕРОПРИЯТИЯ")
-        else:
-            # Draft: show required fields; AUTO is blue disabled and empty
-            st.text_input("Кол-во посетителей всего, тыс.", value="", disabled=True, key="auto_visitors_total")
-            for lab, key in [
-                ("Средняя цена билета", "w_ticket"),
-                ("GMV", "w_gmv"),
-                ("Агентская комиссия", "w_fee"),
-                ("Количество проданных билетов через виджит/витрину", "w_widget"),
-            ]:
-                st.text_input(lab, value=str(draft_value(lab)), key=key)
-                st.session_state["filter_inputs"][norm(lab)] = st.session_state.get(key, "")
-
-    with col3:
-        st.subheader("💰 Бюджет")
-        if calculated:
-            render_block_truth("БЮДЖЕТ")
-        else:
-            for lab, key in [
-                ("Интеграционный платеж (организатору)", "w_integration"),
-                ("Продакшен фото-зоны и лайтбокса, букингсекретных артистов", "w_production"),
-            ]:
-                st.text_input(lab, value=str(draft_value(lab)), key=key)
-                st.session_state["filter_inputs"][norm(lab)] = st.session_state.get(key, "")
-            st.text_input("Общий бюджет", value="", disabled=True, key="auto_total_budget")
-
-    with col4:
-        st.subheader("📈 Эффективность")
-        if calculated:
-            render_block_truth("ЭФФЕКТИВНОСТЬ")
+            st.button("🧮 Рассчитать", disabled=True)
         else:
-            for lab, key in [
-                ("Стоимость привлеченного клиента", "auto_cac"),
-                ("Стоимость за контакт", "auto_cpc"),
-                ("Стоимость за охваченного пользователя", "auto_cpu"),
-                ("Стоимость за посетителя мероприятия", "auto_cpv"),
-            ]:
-                st.text_input(lab, value="", disabled=True, key=key)
+            st.form_submit_button("🧮 Рассчитать", on_click=run_calculation, args=(root_xlsx,))
 
     st.divider()
 
     # ----------------------------
     # Tables (3)
     # ----------------------------
-    dropdown_options = {"Описание": descr_options, "Форматы": format_options}
-
-    for act in ACTIVATION_TYPES:
-        st.markdown(f"### {act}")
-
-        if calculated:
-            df_show = truth_tables.get(act, build_empty_table(headers_b_to_m, 0))
-            _ = aggrid_table(
-                df=df_show,
-                editable=False,
-                dropdown_options=dropdown_options,
-                height=240 if len(df_show) <= 6 else 360,
-                key=f"grid_truth_{norm(act)}",
-            )
-        else:
-            df_draft = st.session_state["table_inputs"].get(act, build_empty_table(headers_b_to_m, 0))
-            df_new = aggrid_table(
-                df=df_draft,
-                editable=True,
-                dropdown_options=dropdown_options,
-                height=240 if len(df_draft) <= 6 else 360,
-                key=f"grid_draft_{norm(act)}",
-            )
-            st.session_state["table_inputs"][act] = df_new
+    render_tables(headers_b_to_m, group_counts, dropdown_options)
 
     st.divider()
 
     # ----------------------------
-    # Buttons
+    # Legend + download
     # ----------------------------
-    st.markdown(
-        """<div class="mtc-legend">
-  <span class="mtc-legend-item"><span class="mtc-swatch red"></span>🔴 Авторасчёт</span>
-  <span class="mtc-legend-item"><span class="mtc-swatch white"></span>⬜ Ввод пользователя</span>
-</div>""",
-        unsafe_allow_html=True,
-    )
+    st.markdown(LEGEND_HTML, unsafe_allow_html=True)
 
-    if st.button("🧮 Рассчитать", disabled=calculated):
-        st.session_state["truth_filters_rows"] = read_filters_rows_truth(root_xlsx, "Фильтры")
-        headers_truth, df_truth_a_to_m = read_media_factors_truth(root_xlsx, "Медиа факторы")
-        st.session_state["truth_tables"] = split_tables_from_truth(df_truth_a_to_m, headers_truth)
+    render_download(root_moscow_xlsx, moscow_mtime)
 
-        st.session_state["calculated"] = True
-        st.rerun()
-
-    # Download Москва-file "as is" (no openpyxl, no modification)
-    try:
-        with open(root_moscow_xlsx, "rb") as f:
-            st.download_button(
-                label="💾 Скачать файл (.xlsx)",
-                data=f,
-                file_name="Калькулятор_Москва.xlsx",
-                mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-            )
-    except Exception:
-        st.error("Не удалось открыть файл 'Калькулятор_Москва.xlsx' для скачивания. Проверьте, что файл доступен.")
+    if debug_enabled():
+        render_cache_stats()
 
 
 if __name__ == "__main__":